@@ -1,12 +1,46 @@
 import os
-from flask import Flask, request, jsonify, abort
-from models import setup_db, Movie, Actor
+from flask import (Flask, request, jsonify, abort, Response,
+                   stream_with_context, _request_ctx_stack)
+from werkzeug.exceptions import HTTPException
+from sqlalchemy.exc import OperationalError
+from models import setup_db, db, Movie, Actor
 from flask_cors import CORS
 
-from auth import AuthError, requires_auth
+from auth import (AuthError, requires_auth, get_token_auth_header,
+                  verify_token, check_permission_mask)
+from changefeed import (CHANGES_PER_PAGE, changes_since, readable_resources,
+                        stream_changes, head_seq, pruned_seq, prune_changes,
+                        get_listener)
+from idempotency import idempotent
+from loadshed import init_load_shedding
+from profiler import (PROFILE_MAX_SECONDS, PROFILE_DEFAULT_INTERVAL_MS,
+                      sampler, slow_queries)
+from tracing import init_tracing, span
 
 
 ACTORS_PER_PAGE = 5
+BATCH_MAX_REQUESTS = 10
+# routes which can not be answered within a batch
+BATCH_EXCLUDED_ENDPOINTS = ('stream_changes_events',)
+# routes reading whole tables, shed first under load
+EXPENSIVE_ENDPOINTS = ('get_actors', 'get_movies', 'get_changes', 'batch')
+# long lived routes left out of the concurrency limit
+LOAD_SHED_EXEMPT_ENDPOINTS = ('stream_changes_events', 'profile')
+# long lived routes left out of tracing, their root span would stay open
+# for the lifetime of the stream
+TRACING_EXEMPT_ENDPOINTS = ('stream_changes_events',)
+
+
+def batch_weight(request):
+    """
+    return the number of sub-requests of a /batch request, the number of
+    requests it counts for in the concurrency limit
+    """
+    body = request.get_json(silent=True)
+    sub_requests = body.get('requests') if isinstance(body, dict) else None
+    if not isinstance(sub_requests, list):
+        return 1
+    return max(1, min(len(sub_requests), BATCH_MAX_REQUESTS))
 
 
 def paginate(request, actors):
@@ -17,7 +51,8 @@ def paginate(request, actors):
     start = (page - 1) * ACTORS_PER_PAGE
     end = start + ACTORS_PER_PAGE
 
-    all_actors = [a.format() for a in actors]
+    with span('format', count=len(actors)):
+        all_actors = [a.format() for a in actors]
     current_actors = all_actors[start:end]
     return current_actors
 
@@ -26,6 +61,9 @@ def create_app(test_config=None):
 
     app = Flask(__name__)
     setup_db(app)
+    init_tracing(app, TRACING_EXEMPT_ENDPOINTS)
+    init_load_shedding(app, EXPENSIVE_ENDPOINTS, LOAD_SHED_EXEMPT_ENDPOINTS,
+                       {'batch': batch_weight})
 
     # Set up CORS. Allow '*' for origins. Delete the sample route
     CORS(app, resources={r"/*": {"origins": "*"}})
@@ -35,7 +73,8 @@ def create_app(test_config=None):
     @app.after_request
     def after_request(response):
         response.headers.add(
-            'Access-Control-Allow-Headers', 'Content-Type, Authorization'
+            'Access-Control-Allow-Headers',
+            'Content-Type, Authorization, Idempotency-Key'
         )
         response.headers.add(
             'Access-Control-Allow-Headers', 'GET, POST, PATCH, DELETE, OPTIONS'
@@ -55,26 +94,36 @@ def create_app(test_config=None):
         returns status code 200 and
             json {"success": True,
                   "actors": actors,
-                  'total_actors': total actors length)}
-            where actors is the list of actors
+                  'total_actors': total actors length),
+                  "seq": seq}
+            where actors is the list of actors and seq the head of the
+            change log, read before them, to sync them from
             or appropriate status code indicating reason for failure
         """
         try:
+            seq = head_seq()
             actors = Actor.query.order_by(Actor.id).all()
             cur_actors = paginate(request, actors)
             return jsonify({'success': True,
                             'actors': cur_actors,
-                            'total_actors': len(actors)})
+                            'total_actors': len(actors),
+                            'seq': seq})
+        except OperationalError:
+            raise
         except BaseException:
             abort(422)
 
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @idempotent
     def create_actor():
         """
         returns status code 200 and json {"success": True, "actor": actor}
             where actor an array containing only the newly created actor
             or appropriate status code indicating reason for failure
+
+        a request sent again with the same Idempotency-Key header
+        returns the stored response without creating another actor
         """
         try:
             body = request.get_json()
@@ -87,6 +136,8 @@ def create_app(test_config=None):
             new_actor.insert()
             return jsonify({'success': True,
                             'actor': new_actor.format()})
+        except OperationalError:
+            raise
         except BaseException:
             abort(422)
 
@@ -119,6 +170,8 @@ def create_app(test_config=None):
 
             return jsonify({'success': True,
                             'actor': actor.format()})
+        except OperationalError:
+            raise
         except BaseException:
             abort(422)
 
@@ -139,6 +192,8 @@ def create_app(test_config=None):
 
             return jsonify({'success': True,
                             'delete': actor_id})
+        except OperationalError:
+            raise
         except BaseException:
             abort(422)
 
@@ -151,26 +206,36 @@ def create_app(test_config=None):
         returns status code 200 and json
             {"success": True,
              "movies": movies,
-             'total_movies': total movies length}
-            where movies is the list of movies
+             'total_movies': total movies length,
+             "seq": seq}
+            where movies is the list of movies and seq the head of the
+            change log, read before them, to sync them from
             or appropriate status code indicating reason for failure
         """
         try:
+            seq = head_seq()
             movies = Movie.query.order_by(Movie.id).all()
             cur_movies = paginate(request, movies)
             return jsonify({'success': True,
                             'movies': cur_movies,
-                            'total_movies': len(movies)})
+                            'total_movies': len(movies),
+                            'seq': seq})
+        except OperationalError:
+            raise
         except BaseException:
             abort(422)
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @idempotent
     def create_movie():
         """
         returns status code 200 and json {"success": True, "movie": movie}
             where movie an array containing only the newly created movie
             or appropriate status code indicating reason for failure
+
+        a request sent again with the same Idempotency-Key header
+        returns the stored response without creating another movie
         """
         try:
             body = request.get_json()
@@ -182,6 +247,8 @@ def create_app(test_config=None):
             new_movie.insert()
             return jsonify({'success': True,
                             'movie': new_movie.format()})
+        except OperationalError:
+            raise
         except BaseException:
             abort(422)
 
@@ -211,6 +278,8 @@ def create_app(test_config=None):
 
             return jsonify({'success': True,
                             'movie': movie.format()})
+        except OperationalError:
+            raise
         except BaseException:
             abort(422)
 
@@ -231,9 +300,210 @@ def create_app(test_config=None):
 
             return jsonify({'success': True,
                             'delete': movie_id})
+        except OperationalError:
+            raise
         except BaseException:
             abort(422)
 
+    # Changes Routes
+
+    @app.route('/changes')
+    @requires_auth(('get:actors', 'get:movies'))
+    def get_changes():
+        """
+        returns status code 200 and json
+            {"success": True,
+             "changes": changes,
+             "last_seq": seq,
+             "has_more": has more changes}
+            where changes are the changes after the seq of the since
+            argument, of the resources the token can read,
+            or appropriate status code indicating reason for failure
+
+        a client keeps last_seq and sends it as since of its next request,
+        it should abort 410 if changes after since were pruned, the client
+        then reloads the records
+        """
+        try:
+            prune_changes()
+            since = request.args.get('since', 0, type=int)
+            resources = readable_resources(
+                _request_ctx_stack.top.permission_mask)
+            changes = changes_since(since, resources, CHANGES_PER_PAGE + 1)
+            # read after the changes, a prune meanwhile is not missed
+            stale = since < pruned_seq()
+            has_more = len(changes) > CHANGES_PER_PAGE
+            changes = changes[:CHANGES_PER_PAGE]
+        except OperationalError:
+            raise
+        except BaseException:
+            abort(422)
+        if stale:
+            abort(410)
+        return jsonify({'success': True,
+                        'changes': changes,
+                        'last_seq': changes[-1]['seq'] if changes else since,
+                        'has_more': has_more})
+
+    @app.route('/changes/head')
+    @requires_auth(('get:actors', 'get:movies'))
+    def get_changes_head():
+        """
+        returns status code 200 and json {"success": True, "seq": seq}
+            where seq is the seq of the last committed change, for a
+            client to sync or stream from without reading the change log
+            or appropriate status code indicating reason for failure
+        """
+        try:
+            return jsonify({'success': True, 'seq': head_seq()})
+        except OperationalError:
+            raise
+        except BaseException:
+            abort(422)
+
+    @app.route('/changes/stream')
+    @requires_auth(('get:actors', 'get:movies'))
+    def stream_changes_events():
+        """
+        returns status code 200 and a text/event-stream of the changes
+            after the seq of the Last-Event-ID header or the since
+            argument, of the resources the token can read, as they are
+            committed, until the token expires
+            or status code 410 if changes after it were pruned, 503 if
+            MAX_STREAMS streams are open in this process
+        """
+        since = request.headers.get('Last-Event-ID', None, type=int)
+        if since is None:
+            since = request.args.get('since', 0, type=int)
+        if since < pruned_seq():
+            abort(410)
+        ctx = _request_ctx_stack.top
+        resources = readable_resources(ctx.permission_mask)
+        expires_at = ctx.current_user.get('exp', None)
+        listener = get_listener(app)
+        subscriber = listener.subscribe()
+        if subscriber is None:
+            abort(503)
+        response = Response(
+            stream_with_context(stream_changes(
+                app, subscriber, since, resources, expires_at)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache',
+                     'X-Accel-Buffering': 'no'})
+        # a stream closed before it started never runs its finally
+        response.call_on_close(lambda: listener.unsubscribe(subscriber))
+        return response
+
+    # Debug Routes
+
+    @app.route('/debug/profile', methods=['POST'])
+    @requires_auth('debug:profile')
+    def profile():
+        """
+        returns status code 200 and the collapsed stacks of the threads of
+            this worker sampled for the requested seconds, one
+            "frame;frame count" line per stack, as text for flamegraph.pl
+            or speedscope, the X-Profile-Pid header names the worker
+            or appropriate status code indicating reason for failure
+
+        the request body is {"seconds": seconds, "interval_ms": interval},
+        seconds is at most PROFILE_MAX_SECONDS
+        """
+        body = request.get_json(silent=True) or {}
+        seconds = body.get('seconds', None)
+        interval_ms = body.get('interval_ms', PROFILE_DEFAULT_INTERVAL_MS)
+        if(not isinstance(seconds, (int, float)) or
+           not 0 < seconds <= PROFILE_MAX_SECONDS or
+           not isinstance(interval_ms, (int, float)) or interval_ms < 1):
+            abort(422)
+        result = sampler.profile(seconds, interval_ms / 1000)
+        if result is None:
+            abort(409)
+        collapsed, samples = result
+        return Response(collapsed, mimetype='text/plain',
+                        headers={'X-Profile-Samples': str(samples),
+                                 'X-Profile-Pid': str(os.getpid())})
+
+    @app.route('/debug/slow-queries')
+    @requires_auth('debug:profile')
+    def get_slow_queries():
+        """
+        returns status code 200 and json
+            {"success": True, "queries": queries}
+            where queries are the slowest statements of this worker,
+            slowest first, with their parameters, duration and plan
+        """
+        return jsonify({'success': True,
+                        'queries': slow_queries.queries()})
+
+    # Batch Route
+
+    def run_sub_request(path, payload, granted):
+        """
+        return the response of a single GET sub-request of /batch
+
+        Keyword arguments:
+        path -- the sub-request path, optionally with a query string
+        payload -- the decoded jwt payload of the batch request
+        granted -- permission mask of the batch request token
+
+        the view is called without its requires_auth wrapper, the
+        permission it requires is checked against granted instead
+        """
+        with app.test_request_context(path, method='GET'), \
+                span('batch.sub_request', path=path):
+            try:
+                adapter = app.create_url_adapter(request)
+                endpoint, view_args = adapter.match(request.path,
+                                                    method='GET')
+                view = app.view_functions[endpoint]
+                if(not hasattr(view, 'permission_mask') or
+                   endpoint in BATCH_EXCLUDED_ENDPOINTS):
+                    abort(404)
+                check_permission_mask(view.permission_mask, granted)
+                _request_ctx_stack.top.current_user = payload
+                _request_ctx_stack.top.permission_mask = granted
+                rv = view.__wrapped__(**view_args)
+            except (HTTPException, AuthError) as e:
+                rv = app.handle_user_exception(e)
+            return app.make_response(rv)
+
+    @app.route('/batch', methods=['POST'])
+    def batch():
+        """
+        returns status code 200 and json
+            {"success": True,
+             "responses": [{"path": path,
+                            "status": status code,
+                            "body": json body}, ...]}
+            where responses are in the order of the requested paths
+            or appropriate status code indicating reason for failure
+
+        the request body is {"requests": [{"path": "/actors?page=2"}, ...]}
+        the token is decoded once, every sub-request is checked against
+        the permission of its route and all of them share one db session
+        """
+        payload, granted = verify_token(get_token_auth_header())
+        body = request.get_json(silent=True) or {}
+        sub_requests = body.get('requests', None)
+        if(not isinstance(sub_requests, list) or not sub_requests
+           or len(sub_requests) > BATCH_MAX_REQUESTS):
+            abort(422)
+        paths = [r.get('path') if isinstance(r, dict) else None
+                 for r in sub_requests]
+        if(any(not isinstance(p, str) or not p.startswith('/')
+               for p in paths)):
+            abort(422)
+
+        responses = []
+        for path in paths:
+            response = run_sub_request(path, payload, granted)
+            responses.append({'path': path,
+                              'status': response.status_code,
+                              'body': response.get_json(silent=True)})
+        return jsonify({'success': True,
+                        'responses': responses})
+
     # Error Handling
 
     @app.errorhandler(422)
@@ -244,6 +514,22 @@ def create_app(test_config=None):
             "message": "unprocessable"
         }), 422
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+        }), 409
+
+    @app.errorhandler(410)
+    def gone(error):
+        return jsonify({
+            "success": False,
+            "error": 410,
+            "message": "gone"
+        }), 410
+
     @app.errorhandler(404)
     def unprocessable(error):
         return jsonify({
@@ -252,6 +538,21 @@ def create_app(test_config=None):
             "message": "resource not found"
         }), 404
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        }), 503, {'Retry-After': '1'}
+
+    # i.e. the statement_timeout set from the request deadline, the routes
+    # re-raise it so that a slow database is answered 503, not 422
+    @app.errorhandler(OperationalError)
+    def database_unavailable(error):
+        db.session.rollback()
+        return service_unavailable(error)
+
     @app.errorhandler(AuthError)
     def handle_auth_error(error):
         return jsonify({
@@ -1,14 +1,22 @@
 import os
 import json
+import threading
+from time import time
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 
+from authorization import permission_mask, payload_mask
+from loadshed import remaining
+from tracing import span, traced
+
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
+JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+VERIFIED_TOKENS_SIZE = 1024
 
 # AuthError Exception
 '''
@@ -62,25 +70,27 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
+def check_permission_mask(required, granted):
     """
-    return true if payload is included the permission
+    return true if any permission of the required mask is granted
 
     Keyword arguments:
-    permission -- string permission (i.e. 'post:drink')
-    payload -- decoded jwt payload
-
-    it should raise an AuthError if permissions are not included in the payload
-    it should raise an AuthError if the requested permission string is not in
-    the payload permissions array
+    required -- permission mask (see authorization.permission_mask)
+    granted -- permission mask of the decoded jwt payload
+    (see authorization.payload_mask)
+
+    it should raise an AuthError if neither permissions nor roles are
+    included in the payload
+    it should raise an AuthError if none of the required permissions
+    is granted
     """
-    if 'permissions' not in payload:
+    if granted is None:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    if not granted & required:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -88,6 +98,25 @@ def check_permissions(permission, payload):
     return True
 
 
+def check_permissions(permission, payload):
+    """
+    return true if payload is included the permission
+
+    Keyword arguments:
+    permission -- string permission (i.e. 'post:actors')
+    payload -- decoded jwt payload
+
+    it should raise an AuthError if permissions are not included in the payload
+    it should raise an AuthError if the requested permission string is not in
+    the payload permissions array
+    it should raise a ValueError if the permission is unknown, as
+    requires_auth does
+    """
+    return check_permission_mask(permission_mask(permission),
+                                 payload_mask(payload))
+
+
+@traced('verify_decode_jwt')
 def verify_decode_jwt(token):
     """
     return the decoded payload
@@ -96,15 +125,29 @@ def verify_decode_jwt(token):
     token -- a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using Auth0 /.well-known/jwks.json,
+    fetched within the deadline of the request
     it should decode the payload from the token
     it should validate the claims
 
     !!NOTE urlopen has a common certificate error described here:
     https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
     """
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    timeout = remaining()
+    if timeout is not None and timeout <= 0:
+        raise AuthError({
+            'code': 'deadline_exceeded',
+            'description': 'Request deadline exceeded.'
+        }, 503)
+    try:
+        with span('jwks.fetch', domain=AUTH0_DOMAIN):
+            jsonurl = urlopen(JWKS_URL, timeout=timeout)
+            jwks = json.loads(jsonurl.read())
+    except OSError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -124,13 +167,14 @@ def verify_decode_jwt(token):
             }
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            with span('jwt.decode', kid=rsa_key['kid']):
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer='https://' + AUTH0_DOMAIN + '/'
+                )
 
             return payload
 
@@ -156,25 +200,93 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+class TokenCache:
+    '''
+    bounded cache of verified tokens with their payload and permission
+    mask, an entry expires with the exp claim of its token
+
+    lookups take no lock (a dict read is atomic), the oldest entry is
+    evicted first once the cache is full
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        entry = self.entries.get(token)
+        if entry is None or entry[2] <= time():
+            return None
+        return entry
+
+    def put(self, token, payload, granted, expires_at):
+        with self.lock:
+            self.entries.pop(token, None)
+            self.entries[token] = (payload, granted, expires_at)
+            while len(self.entries) > self.size:
+                del self.entries[next(iter(self.entries))]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+verified_tokens = TokenCache(VERIFIED_TOKENS_SIZE)
+
+
+def verify_token(token):
+    """
+    return (payload, granted) where payload is the decoded payload of the
+    token and granted its permission mask
+
+    a token is verified with verify_decode_jwt and its mask compiled
+    once, then both are served from verified_tokens until the token
+    expires, so that a request only checks its permission with an AND
+    """
+    entry = verified_tokens.get(token)
+    if entry is not None:
+        return entry[0], entry[1]
+    payload = verify_decode_jwt(token)
+    granted = payload_mask(payload)
+    if isinstance(payload.get('exp', None), (int, float)):
+        verified_tokens.put(token, payload, granted, payload['exp'])
+    return payload, granted
+
+
 def requires_auth(permission=''):
     '''
     return the decorator which passes the decoded payload to the decorated method
 
     Keyword arguments:
-    permission -- string permission (i.e. 'post:drink')
+    permission -- string permission (i.e. 'post:actors') or a tuple of
+    string permissions, any one of which is enough
 
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
-    it should use the check_permissions method validate claims and
-    check the requested permission
+    it should use the verify_token method to decode the jwt
+    it should use the check_permission_mask method validate claims and
+    check the requested permission, compiled once when decorating
+
+    the payload and its permission mask are kept on the request context
+    as current_user and permission_mask
     '''
+    required = permission_mask(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with span('requires_auth', permission=permission):
+                token = get_token_auth_header()
+                payload, granted = verify_token(token)
+                ctx = _request_ctx_stack.top
+                ctx.current_user = payload
+                ctx.permission_mask = granted
+                check_permission_mask(required, granted)
             return f(*args, **kwargs)
 
+        # expose the required permission so that /batch can check it
+        # against an already decoded payload
+        wrapper.permission = permission
+        wrapper.permission_mask = required
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,115 @@
+import os
+from functools import lru_cache
+
+
+'''
+Permissions
+every permission owns one bit of a mask, so checking a permission
+against a decoded jwt payload is a single AND of two integers
+'''
+
+PERMISSIONS = (
+    'get:actors',
+    'post:actors',
+    'patch:actors',
+    'delete:actors',
+    'get:movies',
+    'post:movies',
+    'patch:movies',
+    'delete:movies',
+    # admin only, samples the running worker (see profiler.py)
+    'debug:profile',
+)
+
+PERMISSION_BITS = {p: 1 << i for i, p in enumerate(PERMISSIONS)}
+
+# Roles with their permissions, as described in README.md
+ROLES = {
+    'Casting Assistant': (
+        'get:actors',
+        'get:movies',
+    ),
+    'Casting Director': (
+        'get:actors',
+        'post:actors',
+        'patch:actors',
+        'delete:actors',
+        'get:movies',
+        'patch:movies',
+    ),
+    'Executive Producer': (
+        'get:actors',
+        'post:actors',
+        'patch:actors',
+        'delete:actors',
+        'get:movies',
+        'post:movies',
+        'patch:movies',
+        'delete:movies',
+    ),
+    'Administrator': PERMISSIONS,
+}
+
+# claim of the jwt payload carrying role names, for tokens without
+# a permissions claim
+ROLES_CLAIM = os.environ.get('ROLES_CLAIM', 'roles')
+
+
+def compile_permissions(permissions):
+    """
+    return the mask of the known permissions, unknown ones are ignored
+
+    Keyword arguments:
+    permissions -- iterable of string permissions (i.e. 'post:actors')
+    """
+    mask = 0
+    for permission in permissions:
+        mask |= PERMISSION_BITS.get(permission, 0)
+    return mask
+
+
+ROLE_MASKS = {role: compile_permissions(p) for role, p in ROLES.items()}
+
+
+def permission_mask(permission):
+    """
+    return the mask required by requires_auth
+
+    Keyword arguments:
+    permission -- string permission (i.e. 'post:actors') or a tuple of
+    string permissions, any one of which is enough
+
+    it should raise a ValueError if a permission is unknown, so that
+    typos fail when the route is decorated
+    """
+    if isinstance(permission, str):
+        permission = (permission,) if permission else ()
+    mask = 0
+    for p in permission:
+        if p not in PERMISSION_BITS:
+            raise ValueError(f'Unknown permission {p!r}.')
+        mask |= PERMISSION_BITS[p]
+    return mask
+
+
+@lru_cache(maxsize=256)
+def _compile_claims(permissions, roles):
+    mask = compile_permissions(permissions)
+    for role in roles:
+        mask |= ROLE_MASKS.get(role, 0)
+    return mask
+
+
+def payload_mask(payload):
+    """
+    return the mask of the permissions granted by a decoded jwt payload
+    or None if the payload carries neither permissions nor roles
+
+    tokens of the same role carry the same claims, so the mask is
+    compiled once per distinct set of claims and cached
+    """
+    permissions = payload.get('permissions', None)
+    roles = payload.get(ROLES_CLAIM, None)
+    if(not isinstance(permissions, list) and not isinstance(roles, list)):
+        return None
+    return _compile_claims(tuple(permissions or ()), tuple(roles or ()))
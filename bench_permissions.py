@@ -0,0 +1,75 @@
+import os
+import time
+import timeit
+
+from jose import jwt
+
+os.environ.setdefault('AUTH0_DOMAIN', 'example.auth0.com')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'CastingAgency')
+
+from auth import (AuthError, check_permission_mask,  # noqa: E402
+                  verified_tokens, verify_token)
+from authorization import (ROLES, permission_mask,  # noqa: E402
+                           payload_mask)
+
+'''
+Micro-benchmark of the permission check done on every request,
+the list scan check_permissions() used to do against the compiled mask.
+The payload and mask of a token are cached by verify_token() until the
+token expires, so a request looks its token up and ANDs the masks
+
+    python bench_permissions.py
+'''
+
+NUMBER = 1000000
+
+
+def check_permissions_list(permission, payload):
+    if 'permissions' not in payload:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Permissions not included in JWT.'
+        }, 400)
+
+    if permission not in payload['permissions']:
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permission not found.'
+        }, 403)
+    return True
+
+
+def bench(label, stmt, number=NUMBER):
+    seconds = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f'{label:<42} {seconds / number * 1e9:8.1f} ns/check')
+
+
+if __name__ == '__main__':
+    # worst case of the list scan, the last permission of the producer
+    payload = {'permissions': list(ROLES['Executive Producer'])}
+    role_payload = {'roles': ['Executive Producer']}
+    permission = payload['permissions'][-1]
+    required = permission_mask(permission)
+
+    bench('list scan (check_permissions before)',
+          lambda: check_permissions_list(permission, payload))
+    bench('payload_mask (permissions claim)',
+          lambda: payload_mask(payload))
+    bench('payload_mask (roles claim)',
+          lambda: payload_mask(role_payload))
+    granted = payload_mask(payload)
+    bench('mask check (check_permission_mask)',
+          lambda: check_permission_mask(required, granted))
+    bench('payload_mask + check (uncached token)',
+          lambda: check_permission_mask(required, payload_mask(payload)))
+    # lower bound of the verify_decode_jwt() every request did before,
+    # HS256 is cheaper than the RS256 signature of auth0 tokens
+    token = jwt.encode(dict(payload, exp=time.time() + 3600), 'secret')
+    bench('jwt.decode (HS256) + list scan (before)',
+          lambda: check_permissions_list(
+              permission, jwt.decode(token, 'secret', algorithms='HS256')),
+          number=10000)
+    verified_tokens.put(token, payload, granted, time.time() + 3600)
+    bench('verify_token + check (cached token)',
+          lambda: check_permission_mask(required, verify_token(token)[1]))
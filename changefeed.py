@@ -0,0 +1,278 @@
+import os
+import time
+import queue
+import select
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import psycopg2
+from flask import json
+from sqlalchemy import text
+
+from authorization import PERMISSION_BITS
+from models import db, Change, ChangeHorizon, CHANGES_CHANNEL
+
+
+CHANGES_PER_PAGE = 100
+# seconds between the comments keeping an idle stream open
+HEARTBEAT_INTERVAL = 15
+SUBSCRIBER_QUEUE_SIZE = 1000
+# streams a process serves at once, each holds a worker thread so keep it
+# well below the threads of a worker
+MAX_STREAMS = int(os.environ.get('MAX_STREAMS', 16))
+RECONNECT_DELAY = 1
+# seconds changes are kept, a client which last synced earlier reloads
+CHANGES_RETENTION = int(os.environ.get('CHANGES_RETENTION',
+                                       30 * 24 * 60 * 60))
+# the change log is pruned at most once per interval and process
+PRUNE_INTERVAL = 60
+
+# permission a token needs to read the changes of each resource
+RESOURCE_PERMISSIONS = {
+    'actors': 'get:actors',
+    'movies': 'get:movies',
+}
+
+logger = logging.getLogger(__name__)
+_last_prune = 0
+
+
+def readable_resources(granted):
+    """
+    return the resources whose changes the permission mask can read
+    """
+    return [resource for resource, permission in RESOURCE_PERMISSIONS.items()
+            if granted & PERMISSION_BITS[permission]]
+
+
+def changes_since(since, resources, limit):
+    """
+    return at most limit formatted changes after the seq since
+
+    Keyword arguments:
+    since -- the last seq the client has seen
+    resources -- the resources to return the changes of
+    limit -- the maximum number of changes
+    """
+    changes = Change.query.filter(
+        Change.seq > since,
+        Change.resource.in_(resources)
+    ).order_by(Change.seq).limit(limit).all()
+    return [c.format() for c in changes]
+
+
+def pruned_seq():
+    """
+    return the seq up to which the change log was pruned, a client
+    which last saw an older seq can not sync from the change log
+    """
+    return db.session.query(ChangeHorizon.pruned_seq) \
+        .filter(ChangeHorizon.id == 1).scalar() or 0
+
+
+def head_seq():
+    """
+    return the seq of the last committed change
+
+    read before the tables, it is the since from which a client
+    syncs the records it reads
+    """
+    head = db.session.query(db.func.max(Change.seq)).scalar()
+    return max(head or 0, pruned_seq())
+
+
+def prune_changes():
+    """
+    delete the changes older than CHANGES_RETENTION seconds and move the
+    horizon past them in the same transaction
+    """
+    global _last_prune
+    if time.time() - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = time.time()
+    cutoff = datetime.utcnow() - timedelta(seconds=CHANGES_RETENTION)
+    pruned = db.session.query(db.func.max(Change.seq)) \
+        .filter(Change.created_at < cutoff).scalar()
+    if pruned is not None:
+        db.session.execute(text(
+            'INSERT INTO change_horizon (id, pruned_seq) VALUES (1, :seq) '
+            'ON CONFLICT (id) DO UPDATE SET pruned_seq = '
+            'GREATEST(change_horizon.pruned_seq, EXCLUDED.pruned_seq)'),
+            {'seq': pruned})
+        Change.query.filter(Change.seq <= pruned) \
+            .delete(synchronize_session=False)
+    db.session.commit()
+
+
+class Subscriber:
+    def __init__(self):
+        self.queue = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        # set when the subscriber falls behind and missed changes
+        self.overflow = False
+
+
+class ChangeListener:
+    '''
+    one LISTEN connection per process, fanning out the changes committed
+    by any process to the queues of the streams of this process
+
+    a notification only carries the seq of a change, the listener reads
+    all changes after the last seq it has seen with one query, so that a
+    burst of notifications or a reconnect never loses a change
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_seq = None
+        # set once LISTEN is issued, changes committed later are notified
+        self.ready = threading.Event()
+
+    def subscribe(self):
+        """
+        return a new subscriber or None if MAX_STREAMS are subscribed
+        """
+        subscriber = Subscriber()
+        with self.lock:
+            if len(self.subscribers) >= MAX_STREAMS:
+                return None
+            self.subscribers.add(subscriber)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run,
+                                               name='change-listener',
+                                               daemon=True)
+                self.thread.start()
+        self.ready.wait(HEARTBEAT_INTERVAL)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                logger.exception('change listener disconnected')
+            time.sleep(RECONNECT_DELAY)
+
+    def listen(self):
+        conn = psycopg2.connect(self.app.config['SQLALCHEMY_DATABASE_URI'])
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANGES_CHANNEL}')
+            self.fetch()
+            self.ready.set()
+            while True:
+                if select.select([conn], [], [], HEARTBEAT_INTERVAL)[0]:
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        self.fetch()
+        finally:
+            conn.close()
+
+    def fetch(self):
+        with self.app.app_context():
+            if self.last_seq is None:
+                self.last_seq = db.session.query(
+                    db.func.coalesce(db.func.max(Change.seq), 0)).scalar()
+                return
+            changes = Change.query.filter(Change.seq > self.last_seq) \
+                .order_by(Change.seq).all()
+            changes = [c.format() for c in changes]
+        if not changes:
+            return
+        self.last_seq = changes[-1]['seq']
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            for change in changes:
+                try:
+                    subscriber.queue.put_nowait(change)
+                except queue.Full:
+                    subscriber.overflow = True
+                    self.unsubscribe(subscriber)
+                    break
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener(app):
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = ChangeListener(app)
+        return _listener
+
+
+def format_event(change):
+    return f"id: {change['seq']}\nevent: change\n" \
+        f"data: {json.dumps(change)}\n\n"
+
+
+def format_resync(since):
+    return f'event: resync\ndata: {json.dumps({"seq": since})}\n\n'
+
+
+def stream_changes(app, subscriber, since, resources, expires_at=None):
+    '''
+    stream_changes(app, subscriber, since, resources, expires_at)
+        yields the server-sent events of the changes after the seq since,
+        first from the change log and then as they are committed
+
+    a client falling too far behind gets a resync event and is
+    disconnected, it should reconnect with the last seq it has seen.
+    A client whose since was pruned meanwhile gets a resync event too
+    and 410 once it reconnects, it should reload the records
+
+    Keyword arguments:
+    subscriber -- the subscription of the stream to get_listener(app)
+    expires_at -- the exp of the token, the stream is closed with a
+    resync event then so that the client reconnects with a fresh token
+    '''
+    try:
+        # stream_with_context runs the generator to its first yield before
+        # the response starts, do not hold it back until a change
+        yield ': connected\n\n'
+        # catch up from the table, changes committed meanwhile are
+        # already queued by the subscription and skipped by seq
+        while True:
+            changes = changes_since(since, resources, CHANGES_PER_PAGE)
+            # read after the changes, a prune meanwhile is not missed
+            stale = since < pruned_seq()
+            db.session.rollback()
+            if stale:
+                yield format_resync(since)
+                return
+            for change in changes:
+                since = change['seq']
+                yield format_event(change)
+            if len(changes) < CHANGES_PER_PAGE:
+                break
+
+        while not subscriber.overflow:
+            timeout = HEARTBEAT_INTERVAL
+            if expires_at is not None:
+                timeout = min(timeout, expires_at - time.time())
+                if timeout <= 0:
+                    break
+            try:
+                change = subscriber.queue.get(timeout=timeout)
+            except queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            if change['seq'] <= since or change['resource'] not in resources:
+                continue
+            since = change['seq']
+            yield format_event(change)
+        yield format_resync(since)
+    finally:
+        get_listener(app).unsubscribe(subscriber)
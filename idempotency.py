@@ -0,0 +1,250 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import request, abort, Response, _request_ctx_stack
+from sqlalchemy.exc import IntegrityError
+
+import loadshed
+from models import db, IdempotencyKey
+
+
+# seconds a stored response is replayed for
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 60 * 60))
+# seconds a duplicate request waits for the first one to finish, at most
+# until its own deadline
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 10))
+IDEMPOTENCY_CACHE_SIZE = 1024
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# expired rows are deleted at most once per interval and process
+EVICT_INTERVAL = 60
+POLL_INTERVAL = 0.05
+
+
+class ResponseCache:
+    '''
+    in-process LRU of stored responses in front of the idempotency_keys
+    table, entries expire with the table rows
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[3] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, fingerprint, status_code, body, expires_at):
+        with self.lock:
+            self.entries[key] = (fingerprint, status_code, body, expires_at)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+cache = ResponseCache(IDEMPOTENCY_CACHE_SIZE)
+# keys whose first request is running in this process
+_running = {}
+_running_lock = threading.Lock()
+_last_eviction = 0
+
+
+def replay(fingerprint, stored):
+    """
+    return the stored response
+
+    it should abort 422 if the key was used with a different request body
+    """
+    stored_fingerprint, status_code, body = stored[:3]
+    if stored_fingerprint != fingerprint:
+        abort(422)
+    response = Response(body, status=status_code,
+                        mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def evict_expired():
+    global _last_eviction
+    if time.time() - _last_eviction < EVICT_INTERVAL:
+        return
+    _last_eviction = time.time()
+    cutoff = datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_TTL)
+    IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete()
+    db.session.commit()
+
+
+def wait_time():
+    """
+    return the seconds a duplicate may wait for the first request
+    """
+    left = loadshed.remaining()
+    if left is None:
+        return IDEMPOTENCY_WAIT
+    return max(0, min(IDEMPOTENCY_WAIT, left))
+
+
+def claim(key, fingerprint):
+    """
+    return (None, claimed_at) if this request now owns the key, else
+    (stored, None) where stored is the (fingerprint, status_code, body,
+    expires_at) of the first request
+
+    a key owned by a request of another process is polled until its
+    response is stored, it should abort 409 if that takes longer than
+    wait_time() seconds
+
+    a claim older than the request deadline (loadshed.REQUEST_TIMEOUT)
+    belongs to a request which died before storing its response, it is
+    taken over
+    """
+    evict_expired()
+    deadline = time.monotonic() + wait_time()
+    while True:
+        now = datetime.utcnow()
+        try:
+            db.session.add(IdempotencyKey(key, fingerprint, now))
+            db.session.commit()
+            return None, now
+        except IntegrityError:
+            db.session.rollback()
+
+        row = db.session.query(
+            IdempotencyKey.fingerprint, IdempotencyKey.status_code,
+            IdempotencyKey.body, IdempotencyKey.created_at,
+            IdempotencyKey.claimed_at
+        ).filter(IdempotencyKey.key == key).one_or_none()
+        db.session.commit()
+        if row is None:
+            continue
+        expires_at = row.created_at + timedelta(seconds=IDEMPOTENCY_TTL)
+        if expires_at <= now:
+            IdempotencyKey.query.filter(IdempotencyKey.key == key).delete()
+            db.session.commit()
+            continue
+        if row.fingerprint != fingerprint:
+            abort(422)
+        if row.status_code is not None:
+            return (row.fingerprint, row.status_code, row.body,
+                    time.time() + (expires_at - now).total_seconds()), None
+        lease = timedelta(seconds=loadshed.REQUEST_TIMEOUT)
+        if row.claimed_at + lease <= now:
+            taken = IdempotencyKey.query.filter(
+                IdempotencyKey.key == key,
+                IdempotencyKey.status_code.is_(None),
+                IdempotencyKey.claimed_at == row.claimed_at
+            ).update({'claimed_at': now}, synchronize_session=False)
+            db.session.commit()
+            if taken:
+                return None, now
+            continue
+        if time.monotonic() > deadline:
+            abort(409)
+        time.sleep(POLL_INTERVAL)
+
+
+def owned(key, claimed_at):
+    return IdempotencyKey.query.filter(
+        IdempotencyKey.key == key,
+        IdempotencyKey.claimed_at == claimed_at)
+
+
+def release(key, claimed_at):
+    db.session.rollback()
+    owned(key, claimed_at).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def store(key, fingerprint, claimed_at, response):
+    """
+    store the response in the transaction of the request which created
+    it and commit both
+
+    it should abort 409 and roll the request back if its claim was taken
+    over meanwhile
+    """
+    body = response.get_data(as_text=True)
+    stored = owned(key, claimed_at).update(
+        {'status_code': response.status_code, 'body': body},
+        synchronize_session=False)
+    if not stored:
+        db.session.rollback()
+        abort(409)
+    db.session.commit()
+    cache.put(key, fingerprint, response.status_code, body,
+              time.time() + IDEMPOTENCY_TTL)
+
+
+def idempotent(f):
+    '''
+    idempotent(f)
+        replays the stored response of a request sent again with the same
+        Idempotency-Key header instead of calling f
+
+    keys are scoped by the token subject, the method and the path,
+    a concurrent duplicate waits for the first request to finish,
+    only successful responses are stored so that failed requests can be
+    retried
+
+    f runs in a savepoint, so the commits of f only release it and the
+    record f creates is committed together with its stored response
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get('Idempotency-Key', None)
+        if header is None:
+            return f(*args, **kwargs)
+        if not header or len(header) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            abort(422)
+        user = getattr(_request_ctx_stack.top, 'current_user', {})
+        key = f"{user.get('sub', '')}:{request.method}:{request.path}:{header}"
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        while True:
+            stored = cache.get(key)
+            if stored is not None:
+                return replay(fingerprint, stored)
+            with _running_lock:
+                running = _running.get(key)
+                if running is None:
+                    running = _running[key] = threading.Event()
+                    break
+            if not running.wait(wait_time()):
+                abort(409)
+
+        try:
+            stored, claimed_at = claim(key, fingerprint)
+            if stored is not None:
+                cache.put(key, *stored)
+                return replay(fingerprint, stored)
+            try:
+                db.session.begin_nested()
+                response = f(*args, **kwargs)
+            except BaseException:
+                release(key, claimed_at)
+                raise
+            if not isinstance(response, Response) or \
+                    not 200 <= response.status_code < 300:
+                release(key, claimed_at)
+                return response
+            store(key, fingerprint, claimed_at, response)
+            return response
+        finally:
+            with _running_lock:
+                del _running[key]
+            running.set()
+
+    return wrapper
@@ -0,0 +1,171 @@
+import os
+import math
+import time
+import threading
+
+from flask import request, g, abort
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+# seconds a request may take, passed down as the timeout of the JWKS
+# fetch and the statement_timeout of postgres
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 10))
+CONCURRENCY_INITIAL_LIMIT = int(os.environ.get('CONCURRENCY_INITIAL_LIMIT',
+                                               20))
+CONCURRENCY_MIN_LIMIT = int(os.environ.get('CONCURRENCY_MIN_LIMIT', 2))
+CONCURRENCY_MAX_LIMIT = int(os.environ.get('CONCURRENCY_MAX_LIMIT', 200))
+# share of the limit expensive routes may use, so that they are shed
+# before cheap ones
+EXPENSIVE_SHARE = 0.5
+
+
+class AdaptiveLimiter:
+    '''
+    concurrency limit adapted to the observed latency (gradient algorithm)
+
+    the limit is multiplied by the gradient between the long term and
+    the recent latency, so it shrinks as soon as requests queue up in a
+    slow dependency, and grows by about sqrt(limit) while latency stays
+    flat. Failed requests (timeouts, 503) decrease it multiplicatively
+    '''
+
+    def __init__(self, initial_limit=CONCURRENCY_INITIAL_LIMIT,
+                 min_limit=CONCURRENCY_MIN_LIMIT,
+                 max_limit=CONCURRENCY_MAX_LIMIT,
+                 smoothing=0.2, tolerance=1.5, long_window=100,
+                 backoff=0.9):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.long_window = long_window
+        self.backoff = backoff
+        self.inflight = 0
+        self.short_rtt = None
+        self.long_rtt = None
+        self.lock = threading.Lock()
+
+    def acquire(self, expensive=False, weight=1):
+        """
+        return true if the request may run, it should then call release
+
+        Keyword arguments:
+        expensive -- true if the request may only use EXPENSIVE_SHARE
+        weight -- the number of requests the request counts for, a
+        request heavier than the limit still runs alone
+        """
+        with self.lock:
+            limit = self.limit * EXPENSIVE_SHARE if expensive else self.limit
+            if self.inflight and self.inflight + weight - 1 >= max(limit, 1):
+                return False
+            self.inflight += weight
+            return True
+
+    def release(self, latency, failed=False, weight=1):
+        """
+        Keyword arguments:
+        latency -- seconds the request took
+        failed -- true if the request timed out or its dependency failed
+        weight -- the weight the request was acquired with
+        """
+        with self.lock:
+            inflight = self.inflight
+            self.inflight -= weight
+            if failed:
+                self.set_limit(self.limit * self.backoff)
+                return
+            if self.long_rtt is None:
+                self.short_rtt = self.long_rtt = latency
+                return
+            self.short_rtt += (latency - self.short_rtt) * 0.5
+            self.long_rtt += (latency - self.long_rtt) / self.long_window
+            # the long term latency drifted up under a sustained overload,
+            # let it recover towards the recent one
+            if self.long_rtt > self.short_rtt * 2:
+                self.long_rtt *= 0.95
+            gradient = max(0.5, min(1.0, self.tolerance * self.long_rtt /
+                                    self.short_rtt))
+            new_limit = self.limit * gradient + math.sqrt(self.limit)
+            # the limit is not what holds the traffic back, do not grow it
+            if new_limit > self.limit and inflight < self.limit / 2:
+                return
+            self.set_limit(self.limit * (1 - self.smoothing) +
+                           new_limit * self.smoothing)
+
+    def set_limit(self, limit):
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+
+def remaining():
+    """
+    return the seconds left until the deadline of the current request,
+    or None outside of a request
+    """
+    deadline = g.get('deadline', None) if g else None
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+@event.listens_for(Session, 'after_begin')
+def set_statement_timeout(session, transaction, connection):
+    left = remaining()
+    if left is None or connection.dialect.name != 'postgresql':
+        return
+    connection.exec_driver_sql(
+        f'SET LOCAL statement_timeout = {max(1, int(left * 1000))}')
+
+
+def init_load_shedding(app, expensive_endpoints=(), exempt_endpoints=(),
+                       weights=None):
+    '''
+    init_load_shedding(app)
+        limits the concurrent requests of a flask application and gives
+        each of them a deadline
+
+    the limit counts the requests running at once in this process, so it
+    only sheds with threaded workers (gunicorn -k gthread), a sync worker
+    runs one request at a time and never reaches it
+
+    Keyword arguments:
+    expensive_endpoints -- endpoints shed first when the limit is reached
+    exempt_endpoints -- endpoints not limited, i.e. long lived streams
+    weights -- dict of endpoints counting for several requests to the
+    function returning the weight of a request, i.e. batches
+    '''
+    limiter = app.limiter = AdaptiveLimiter()
+    weights = weights or {}
+
+    @app.before_request
+    def admit_request():
+        if request.endpoint in exempt_endpoints:
+            return
+        g.deadline = time.monotonic() + REQUEST_TIMEOUT
+        weight = weights[request.endpoint](request) \
+            if request.endpoint in weights else 1
+        if not limiter.acquire(request.endpoint in expensive_endpoints,
+                               weight):
+            abort(503)
+        request.load_shed_weight = weight
+        request.load_shed_start = time.monotonic()
+
+    @app.after_request
+    def record_failure(response):
+        if getattr(request, 'load_shed_start', None) is not None:
+            request.load_shed_failed = response.status_code in (503, 504)
+        return response
+
+    # nested request contexts, such as the /batch sub-requests, did not
+    # acquire the limiter
+    @app.teardown_request
+    def release_request(error=None):
+        start = getattr(request, 'load_shed_start', None)
+        if start is None:
+            return
+        request.load_shed_start = None
+        limiter.release(time.monotonic() - start,
+                        error is not None or
+                        getattr(request, 'load_shed_failed', False),
+                        request.load_shed_weight)
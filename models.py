@@ -1,5 +1,7 @@
 import os
-from sqlalchemy import Column, String, Integer, Date
+from datetime import datetime
+from flask import json
+from sqlalchemy import Column, String, Integer, Date, DateTime, Text, text
 from flask_sqlalchemy import SQLAlchemy
 
 database_path = os.environ['DATABASE_URL']
@@ -8,6 +10,11 @@ if database_path.startswith("postgres://"):
 
 db = SQLAlchemy()
 
+# channel notified with the seq of every change on commit
+CHANGES_CHANNEL = 'changes'
+# key of the advisory lock serializing the writers of the change log
+CHANGES_LOCK_KEY = 7305
+
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
@@ -22,6 +29,31 @@ def setup_db(app, database_path=database_path):
     db.create_all()
 
 
+'''
+record_change(op, record)
+    adds a change of record to the change log in the session of record,
+    so that it is committed atomically with the change itself
+
+    writers are serialized by a transaction level advisory lock, so that
+    changes commit in the order of their seq and a client reading
+    since the last seq it saw never misses one
+'''
+
+
+def record_change(op, record):
+    db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                       {'key': CHANGES_LOCK_KEY})
+    # assigns the id of an inserted record
+    db.session.flush()
+    data = None if op == 'delete' else json.dumps(record.format())
+    change = Change(record.__tablename__, record.id, op, data)
+    db.session.add(change)
+    db.session.flush()
+    # notifications are only delivered once the transaction commits
+    db.session.execute(text('SELECT pg_notify(:channel, :seq)'),
+                       {'channel': CHANGES_CHANNEL, 'seq': str(change.seq)})
+
+
 # Actors with attributes name, age and gender
 class Actor(db.Model):
     __tablename__ = 'actors'
@@ -38,13 +70,16 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        record_change('insert', self)
         db.session.commit()
 
     def update(self):
+        record_change('update', self)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        record_change('delete', self)
         db.session.commit()
 
     def format(self):
@@ -69,13 +104,16 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        record_change('insert', self)
         db.session.commit()
 
     def update(self):
+        record_change('update', self)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        record_change('delete', self)
         db.session.commit()
 
     def format(self):
@@ -83,3 +121,60 @@ class Movie(db.Model):
             'id': self.id,
             'title': self.title,
             'release_date': self.release_date}
+
+
+# Stored responses of POST requests sent with an Idempotency-Key header
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    # status_code and body stay null while the first request is running
+    status_code = Column(Integer)
+    body = Column(Text)
+    created_at = Column(DateTime, nullable=False, index=True)
+    # lease of the running request, renewed when the key is taken over
+    claimed_at = Column(DateTime, nullable=False)
+
+    def __init__(self, key, fingerprint, created_at):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.created_at = created_at
+        self.claimed_at = created_at
+
+
+# Inserts, updates and deletes of actors and movies, in commit order
+class Change(db.Model):
+    __tablename__ = 'changes'
+
+    seq = Column(Integer, primary_key=True)
+    resource = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)
+    # json of the formatted record, null for deletes
+    data = Column(Text)
+    created_at = Column(DateTime, nullable=False)
+
+    def __init__(self, resource, row_id, op, data):
+        self.resource = resource
+        self.row_id = row_id
+        self.op = op
+        self.data = data
+        self.created_at = datetime.utcnow()
+
+    def format(self):
+        return {
+            'seq': self.seq,
+            'resource': self.resource,
+            'id': self.row_id,
+            'op': self.op,
+            'data': json.loads(self.data) if self.data else None,
+            'created_at': self.created_at}
+
+
+# Seq up to which the change log was pruned, a single row
+class ChangeHorizon(db.Model):
+    __tablename__ = 'change_horizon'
+
+    id = Column(Integer, primary_key=True)
+    pruned_seq = Column(Integer, nullable=False)
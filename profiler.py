@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import heapq
+import threading
+from collections import Counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+PROFILE_MAX_SECONDS = 60
+PROFILE_DEFAULT_INTERVAL_MS = 10
+# statements slower than this are kept with their EXPLAIN output
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_CAPACITY = int(os.environ.get('SLOW_QUERY_CAPACITY', 20))
+MAX_PARAMETERS_LENGTH = 1000
+EXPLAINED_STATEMENTS = ('select', 'insert', 'update', 'delete', 'with')
+
+
+class StackSampler:
+    '''
+    statistical profiler of the threads of this worker
+
+    the calling thread reads the stack of every other thread each
+    interval and counts the stacks, which is cheap enough to run in
+    production, and returns them collapsed (one "frame;frame;frame count"
+    line per stack) for flamegraph.pl or speedscope
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = False
+        self.labels = {}
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = (
+                f'{code.co_name} '
+                f'({os.path.basename(code.co_filename)}:'
+                f'{code.co_firstlineno})')
+        return label
+
+    def profile(self, seconds, interval):
+        """
+        return (collapsed stacks, number of samples) of the other threads
+        or None if a profile is already running
+
+        Keyword arguments:
+        seconds -- seconds to sample for
+        interval -- seconds between two samples
+        """
+        with self.lock:
+            if self.busy:
+                return None
+            self.busy = True
+        try:
+            counts, samples = self.sample(time.monotonic() + seconds,
+                                          interval)
+        finally:
+            with self.lock:
+                self.busy = False
+        return (''.join(f'{stack} {count}\n'
+                        for stack, count in counts.most_common()),
+                samples)
+
+    def sample(self, end, interval):
+        me = threading.get_ident()
+        counts = Counter()
+        samples = 0
+        while time.monotonic() < end:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                counts[';'.join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+        return counts, samples
+
+
+class SlowQueryLog:
+    '''
+    bounded ring of the slowest statements, with their parameters,
+    timings and the EXPLAIN output of their plan
+    '''
+
+    def __init__(self, capacity=SLOW_QUERY_CAPACITY):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        # min-heap of (duration, seq, query), the fastest is evicted first
+        self.heap = []
+        self.seq = 0
+
+    def admits(self, duration):
+        return (len(self.heap) < self.capacity or
+                duration > self.heap[0][0])
+
+    def add(self, duration, query):
+        with self.lock:
+            self.seq += 1
+            entry = (duration, self.seq, query)
+            if len(self.heap) < self.capacity:
+                heapq.heappush(self.heap, entry)
+            elif duration > self.heap[0][0]:
+                heapq.heapreplace(self.heap, entry)
+
+    def queries(self):
+        with self.lock:
+            return [q for _, _, q in sorted(self.heap, reverse=True)]
+
+
+sampler = StackSampler()
+slow_queries = SlowQueryLog()
+
+
+def explain(cursor, statement, parameters):
+    """
+    return the lines of the EXPLAIN output of a statement or None
+
+    it runs in a savepoint on the connection of the statement, so that a
+    failed EXPLAIN does not abort the transaction of the request
+    """
+    if not statement.lstrip().lower().startswith(EXPLAINED_STATEMENTS):
+        return None
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            explain_cursor.execute('EXPLAIN ' + statement, parameters)
+            plan = [row[0] for row in explain_cursor.fetchall()]
+            explain_cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            return plan
+        except Exception:
+            explain_cursor.execute(
+                'ROLLBACK TO SAVEPOINT slow_query_explain')
+            return None
+    except Exception:
+        return None
+    finally:
+        explain_cursor.close()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    conn.info.setdefault('slow_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_slow_query(conn, cursor, statement, parameters, context,
+                      executemany):
+    starts = conn.info.get('slow_query_start')
+    if not starts:
+        return
+    duration_ms = (time.perf_counter() - starts.pop()) * 1000
+    if duration_ms < SLOW_QUERY_MS or not slow_queries.admits(duration_ms):
+        return
+    plan = None
+    if not executemany and conn.dialect.name == 'postgresql':
+        plan = explain(cursor, statement, parameters)
+    slow_queries.add(duration_ms, {
+        'statement': statement,
+        'parameters': repr(parameters)[:MAX_PARAMETERS_LENGTH],
+        'duration_ms': round(duration_ms, 3),
+        'executed_at': time.time(),
+        'explain': plan})
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(context):
+    if context.connection is None:
+        return
+    starts = context.connection.info.get('slow_query_start')
+    if starts:
+        starts.pop()
@@ -1,11 +1,33 @@
+import io
 import os
 import json
+import time
+import queue
+import uuid
+import logging
+import tempfile
+import threading
 import unittest
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
+import hashlib
+import psycopg2
+from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
-
+from jose import jwt
+from sqlalchemy import text
+
+import auth
+import changefeed
+import loadshed
+import profiler
+import tracing
 from app import create_app
-from models import setup_db, Actor, Movie
+from auth import (AuthError, requires_auth, check_permission_mask,
+                  check_permissions)
+from authorization import permission_mask, payload_mask
+from models import setup_db, db, Actor, Movie, IdempotencyKey
 
 casting_assistant_auth_header = {
     'Authorization': os.environ['CASTING_ASSISTANT_TOKEN']
@@ -20,6 +42,38 @@ executive_producer_auth_header = {
 }
 
 
+@contextmanager
+def exported_spans(sample_rate):
+    """Export the spans to a temporary file at the given head sampling
+    rate, the yielded list is filled with them on exit"""
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fd)
+    exporter, rate = tracing.exporter, tracing.TRACE_SAMPLE_RATE
+    tracing.exporter = tracing.FileExporter(path)
+    tracing.TRACE_SAMPLE_RATE = sample_rate
+    spans = []
+    try:
+        yield spans
+    finally:
+        tracing.exporter, tracing.TRACE_SAMPLE_RATE = exporter, rate
+        with open(path) as f:
+            spans.extend(json.loads(line) for line in f)
+        os.remove(path)
+
+
+class SlowJWKSHandler(BaseHTTPRequestHandler):
+    """A JWKS endpoint answering after 5 seconds"""
+
+    def do_GET(self):
+        time.sleep(5)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'{"keys": []}')
+
+    def log_message(self, *args):
+        pass
+
+
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
@@ -27,6 +81,7 @@ class TriviaTestCase(unittest.TestCase):
         """Define test variables and initialize app."""
         self.app = create_app()
         self.client = self.app.test_client
+        auth.verified_tokens.clear()
         self.database_path = os.environ['TEST_DATABASE_URL']
 
         setup_db(self.app, self.database_path)
@@ -90,6 +145,88 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
 
+    def test_post_new_actor_replayed_with_idempotency_key(self):
+        headers = dict(casting_director_auth_header,
+                       **{'Idempotency-Key': str(uuid.uuid4())})
+        res = self.client().post('/actors', json=self.new_actor,
+                                 headers=headers)
+        replay = self.client().post('/actors', json=self.new_actor,
+                                    headers=headers)
+        data = json.loads(res.data)
+        replay_data = json.loads(replay.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(data["actor"]["id"], replay_data["actor"]["id"])
+
+    def test_concurrent_duplicates_create_one_actor(self):
+        headers = dict(casting_director_auth_header,
+                       **{'Idempotency-Key': str(uuid.uuid4())})
+        with self.app.app_context():
+            before = Actor.query.count()
+            db.session.rollback()
+        barrier = threading.Barrier(2)
+        responses = []
+
+        def post_actor():
+            barrier.wait()
+            responses.append(self.client().post(
+                '/actors', json=self.new_actor, headers=headers))
+
+        threads = [threading.Thread(target=post_actor) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with self.app.app_context():
+            after = Actor.query.count()
+            db.session.rollback()
+
+        self.assertEqual([r.status_code for r in responses], [200, 200])
+        self.assertEqual(after, before + 1)
+        self.assertEqual(
+            sorted('Idempotent-Replayed' in r.headers for r in responses),
+            [False, True])
+        self.assertEqual(len(set(json.loads(r.data)["actor"]["id"]
+                                 for r in responses)), 1)
+
+    def test_422_if_idempotency_key_reused_with_other_body(self):
+        headers = dict(casting_director_auth_header,
+                       **{'Idempotency-Key': str(uuid.uuid4())})
+        self.client().post('/actors', json=self.new_actor, headers=headers)
+        res = self.client().post('/actors',
+                                 json=dict(self.new_actor, age=36),
+                                 headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+
+    def test_stale_idempotency_claim_taken_over(self):
+        # the claim of a request whose worker died before storing
+        header = str(uuid.uuid4())
+        token = casting_director_auth_header['Authorization'].split()[1]
+        key = f"{jwt.get_unverified_claims(token)['sub']}:POST:/actors:" \
+            f"{header}"
+        body = json.dumps(self.new_actor).encode()
+        with self.app.app_context():
+            db.session.add(IdempotencyKey(
+                key, hashlib.sha256(body).hexdigest(),
+                datetime.utcnow() - timedelta(
+                    seconds=loadshed.REQUEST_TIMEOUT + 1)))
+            db.session.commit()
+
+        res = self.client().post(
+            '/actors', data=body, content_type='application/json',
+            headers=dict(casting_director_auth_header,
+                         **{'Idempotency-Key': header}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
     def test_401_if_post_new_actors_not_include_headers(self):
         res = self.client().post('/actors')
         data = json.loads(res.data)
@@ -283,6 +420,468 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "unprocessable")
 
+    # For changes testing
+
+    def test_get_changes_since_seq_of_actors(self):
+        last_seq = json.loads(self.client().get(
+            '/actors', headers=casting_director_auth_header).data)["seq"]
+        actor = json.loads(self.client().post(
+            '/actors', json=self.new_actor,
+            headers=casting_director_auth_header).data)["actor"]
+
+        res = self.client().get(f'/changes?since={last_seq}',
+                                headers=casting_director_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(len(data["changes"]), 1)
+        self.assertEqual(data["changes"][0]["op"], "insert")
+        self.assertEqual(data["changes"][0]["resource"], "actors")
+        self.assertEqual(data["changes"][0]["data"], actor)
+        self.assertEqual(data["last_seq"], data["changes"][0]["seq"])
+
+    def test_stream_changes_sends_committed_change(self):
+        last_seq = json.loads(self.client().get(
+            '/changes/head', headers=casting_director_auth_header).data)["seq"]
+        heartbeat, changefeed.HEARTBEAT_INTERVAL = \
+            changefeed.HEARTBEAT_INTERVAL, 0.2
+        stream = self.client().get(f'/changes/stream?since={last_seq}',
+                                   headers=casting_director_auth_header,
+                                   buffered=False)
+        chunks = queue.Queue()
+
+        def read_stream():
+            for chunk in stream.response:
+                chunks.put(chunk.decode() if isinstance(chunk, bytes)
+                           else chunk)
+                if chunk.startswith(b'id:' if isinstance(chunk, bytes)
+                                    else 'id:'):
+                    break
+
+        reader = threading.Thread(target=read_stream, daemon=True)
+        try:
+            reader.start()
+            self.assertEqual(chunks.get(timeout=5), ': connected\n\n')
+            actor = json.loads(self.client().post(
+                '/actors', json=self.new_actor,
+                headers=casting_director_auth_header).data)["actor"]
+            event = chunks.get(timeout=5)
+            while event == ': heartbeat\n\n':
+                event = chunks.get(timeout=5)
+            reader.join(5)
+        finally:
+            changefeed.HEARTBEAT_INTERVAL = heartbeat
+            stream.close()
+
+        self.assertEqual(stream.status_code, 200)
+        self.assertEqual(stream.mimetype, 'text/event-stream')
+        self.assertNotIn('traceparent', stream.headers)
+        lines = event.splitlines()
+        change = json.loads(lines[2][len('data: '):])
+        self.assertEqual(lines[0], f"id: {change['seq']}")
+        self.assertEqual(lines[1], 'event: change')
+        self.assertGreater(change['seq'], last_seq)
+        self.assertEqual(change['op'], 'insert')
+        self.assertEqual(change['data'], actor)
+
+    def test_503_if_max_streams_open(self):
+        head = json.loads(self.client().get(
+            '/changes/head', headers=casting_director_auth_header).data)
+        url = f'/changes/stream?since={head["seq"]}'
+        max_streams, changefeed.MAX_STREAMS = changefeed.MAX_STREAMS, 1
+        try:
+            first = self.client().get(url,
+                                      headers=casting_director_auth_header,
+                                      buffered=False)
+            second = self.client().get(url,
+                                       headers=casting_director_auth_header,
+                                       buffered=False)
+            first.close()
+            third = self.client().get(url,
+                                      headers=casting_director_auth_header,
+                                      buffered=False)
+            third.close()
+        finally:
+            changefeed.MAX_STREAMS = max_streams
+        data = json.loads(second.data)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 503)
+        self.assertEqual(data["success"], False)
+        self.assertIn('Retry-After', second.headers)
+        self.assertEqual(third.status_code, 200)
+
+    def test_stream_closed_when_token_expires(self):
+        payload = {'sub': 'expiring', 'roles': ['Casting Assistant'],
+                   'exp': time.time() + 0.5}
+        auth.verified_tokens.put('expiring.token', payload,
+                                 payload_mask(payload), payload['exp'])
+        head = json.loads(self.client().get(
+            '/changes/head', headers=casting_director_auth_header).data)
+        start = time.monotonic()
+        stream = self.client().get(
+            f'/changes/stream?since={head["seq"]}',
+            headers={'Authorization': 'Bearer expiring.token'},
+            buffered=False)
+        try:
+            chunks = [c.decode() if isinstance(c, bytes) else c
+                      for c in stream.response]
+        finally:
+            stream.close()
+
+        self.assertEqual(stream.status_code, 200)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertTrue(chunks[-1].startswith('event: resync\n'))
+        self.assertEqual(json.loads(chunks[-1].split('data: ')[1]),
+                         {'seq': head['seq']})
+
+    def test_410_if_changes_since_pruned(self):
+        self.client().post('/actors', json=self.new_actor,
+                           headers=casting_director_auth_header)
+        retention, changefeed.CHANGES_RETENTION = \
+            changefeed.CHANGES_RETENTION, -1
+        changefeed._last_prune = 0
+        try:
+            res = self.client().get('/changes?since=0',
+                                    headers=casting_director_auth_header)
+        finally:
+            changefeed.CHANGES_RETENTION = retention
+        data = json.loads(res.data)
+        head = json.loads(self.client().get(
+            '/changes/head', headers=casting_director_auth_header).data)
+        stream = self.client().get('/changes/stream?since=0',
+                                   headers=casting_director_auth_header)
+        res_head = self.client().get(f'/changes?since={head["seq"]}',
+                                     headers=casting_director_auth_header)
+
+        self.assertEqual(res.status_code, 410)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "gone")
+        self.assertEqual(stream.status_code, 410)
+        self.assertEqual(res_head.status_code, 200)
+        self.assertEqual(json.loads(res_head.data)["changes"], [])
+
+    def test_401_if_get_changes_without_headers(self):
+        res = self.client().get('/changes?since=0')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data["success"], False)
+
+    # For batch testing
+
+    def test_batch_get_actors_and_movies(self):
+        res = self.client().post(
+            '/batch',
+            json={'requests': [{'path': '/actors'},
+                               {'path': '/movies?page=1'},
+                               {'path': '/actors?page=1000'}]},
+            headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual([r["status"] for r in data["responses"]],
+                         [200, 200, 422])
+        self.assertTrue(len(data["responses"][0]["body"]["actors"]))
+        self.assertTrue(len(data["responses"][1]["body"]["movies"]))
+
+    def test_batch_checks_permission_of_each_sub_request(self):
+        res = self.client().post(
+            '/batch',
+            json={'requests': [{'path': '/actors'},
+                               {'path': '/debug/slow-queries'},
+                               {'path': '/movies'},
+                               {'path': '/changes/stream'},
+                               {'path': '/'}]},
+            headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r["status"] for r in data["responses"]],
+                         [200, 403, 200, 404, 404])
+        self.assertEqual(data["responses"][1]["body"]["success"], False)
+
+    def test_401_if_batch_without_headers(self):
+        res = self.client().post('/batch',
+                                 json={'requests': [{'path': '/actors'}]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data["success"], False)
+
+    def test_422_if_batch_input_invalid(self):
+        res = self.client().post('/batch', json={'requests': []},
+                                 headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "unprocessable")
+
+    # For authorization testing
+
+    def test_permission_mask_of_roles_claim(self):
+        granted = payload_mask({'roles': ['Casting Assistant']})
+
+        self.assertTrue(
+            check_permission_mask(permission_mask('get:actors'), granted))
+        with self.assertRaises(AuthError) as cm:
+            check_permission_mask(permission_mask('post:actors'), granted)
+        self.assertEqual(cm.exception.status_code, 403)
+        with self.assertRaises(AuthError) as cm:
+            check_permission_mask(permission_mask('get:actors'),
+                                  payload_mask({}))
+        self.assertEqual(cm.exception.status_code, 400)
+
+    def test_verified_token_cached_until_expired(self):
+        payload = {'sub': 'cached', 'roles': ['Casting Assistant']}
+        auth.verified_tokens.put('cached.token', payload,
+                                 payload_mask(payload), time.time() + 60)
+        auth.verified_tokens.put('expired.token', payload,
+                                 payload_mask(payload), time.time() - 1)
+
+        res = self.client().get(
+            '/actors', headers={'Authorization': 'Bearer cached.token'})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().post(
+            '/actors', json=self.new_actor,
+            headers={'Authorization': 'Bearer cached.token'})
+        self.assertEqual(res.status_code, 403)
+        self.assertIsNone(auth.verified_tokens.get('expired.token'))
+
+    def test_unknown_permission_fails_when_decorating(self):
+        with self.assertRaises(ValueError):
+            requires_auth('get:drinks')
+
+    def test_check_permissions_matches_requires_auth(self):
+        payload = {'permissions': ['get:actors']}
+
+        self.assertTrue(check_permissions('get:actors', payload))
+        with self.assertRaises(AuthError) as cm:
+            check_permissions('post:actors', payload)
+        self.assertEqual(cm.exception.status_code, 403)
+        with self.assertRaises(ValueError):
+            check_permissions('get:drinks', payload)
+
+    # For load shedding testing
+
+    def test_503_within_deadline_if_jwks_slow(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), SlowJWKSHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        jwks_url, timeout = auth.JWKS_URL, loadshed.REQUEST_TIMEOUT
+        auth.JWKS_URL = f'http://127.0.0.1:{server.server_port}/'
+        loadshed.REQUEST_TIMEOUT = 0.5
+        latencies = []
+
+        def get_actors():
+            start = time.monotonic()
+            res = self.client().get('/actors',
+                                    headers=casting_assistant_auth_header)
+            latencies.append((time.monotonic() - start, res.status_code))
+
+        try:
+            threads = [threading.Thread(target=get_actors)
+                       for i in range(20)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            auth.JWKS_URL, loadshed.REQUEST_TIMEOUT = jwks_url, timeout
+            server.shutdown()
+
+        self.assertEqual(set(code for _, code in latencies), {503})
+        self.assertLess(max(latency for latency, _ in latencies), 1.5)
+
+    def test_503_within_deadline_if_database_slow(self):
+        # another transaction locks the actors table, so GET /actors
+        # blocks until the statement_timeout of its deadline
+        conn = psycopg2.connect(self.database_path)
+        timeout = loadshed.REQUEST_TIMEOUT
+        loadshed.REQUEST_TIMEOUT = 3
+        limit = self.app.limiter.limit
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('LOCK TABLE actors IN ACCESS EXCLUSIVE MODE')
+            start = time.monotonic()
+            res = self.client().get('/actors',
+                                    headers=casting_assistant_auth_header)
+            latency = time.monotonic() - start
+        finally:
+            loadshed.REQUEST_TIMEOUT = timeout
+            conn.rollback()
+            conn.close()
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data["success"], False)
+        self.assertLess(latency, 4.5)
+        self.assertLess(self.app.limiter.limit, limit)
+
+    def test_limiter_sheds_expensive_before_cheap_when_slow(self):
+        limiter = loadshed.AdaptiveLimiter(initial_limit=20)
+        for i in range(20):
+            limiter.acquire()
+        for i in range(100):
+            limiter.release(0.01)
+            limiter.acquire()
+        fast_limit = limiter.limit
+        for i in range(50):
+            limiter.release(1.0)
+            limiter.acquire()
+
+        self.assertLess(limiter.limit, fast_limit)
+        while limiter.inflight >= limiter.limit:
+            limiter.release(1.0)
+        self.assertFalse(limiter.acquire(expensive=True))
+        self.assertTrue(limiter.acquire())
+
+    def test_limiter_counts_batch_by_its_weight(self):
+        limiter = loadshed.AdaptiveLimiter(initial_limit=10)
+
+        self.assertTrue(limiter.acquire(weight=8))
+        self.assertFalse(limiter.acquire(weight=3))
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.inflight, 9)
+        limiter.release(0.01, weight=8)
+        limiter.release(0.01)
+        self.assertEqual(limiter.inflight, 0)
+        # heavier than the limit, it still runs alone
+        self.assertTrue(limiter.acquire(expensive=True, weight=10))
+        self.assertFalse(limiter.acquire())
+
+    # For profiling testing
+
+    def test_403_if_profile_without_permission(self):
+        res = self.client().post('/debug/profile', json={'seconds': 1},
+                                 headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data["success"], False)
+
+    def test_profile_returns_stacks_of_worker(self):
+        payload = {'sub': 'admin', 'roles': ['Administrator'],
+                   'exp': time.time() + 60}
+        auth.verified_tokens.put('admin.token', payload,
+                                 payload_mask(payload), payload['exp'])
+        done = threading.Event()
+        worker = threading.Thread(target=done.wait, name='sampled')
+        worker.start()
+        try:
+            res = self.client().post(
+                '/debug/profile', json={'seconds': 0.2, 'interval_ms': 10},
+                headers={'Authorization': 'Bearer admin.token'})
+        finally:
+            done.set()
+            worker.join()
+        lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Profile-Pid'], str(os.getpid()))
+        self.assertTrue(int(res.headers['X-Profile-Samples']))
+        self.assertTrue(any(line.startswith('sampled;') for line in lines))
+        for line in lines:
+            self.assertTrue(line.rsplit(' ', 1)[1].isdigit())
+
+    def test_one_profile_at_a_time(self):
+        sampler = profiler.StackSampler()
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(sampler.profile(0.3, 0.01)))
+        first.start()
+        time.sleep(0.1)
+        second = sampler.profile(0.1, 0.01)
+        first.join()
+
+        self.assertIsNone(second)
+        self.assertIsNotNone(results[0])
+        self.assertIsNotNone(sampler.profile(0.05, 0.01))
+
+    def test_slow_query_kept_with_plan(self):
+        slow_queries = profiler.slow_queries
+        profiler.slow_queries = profiler.SlowQueryLog(capacity=1)
+        try:
+            with self.app.app_context():
+                db.session.execute(text(
+                    'SELECT pg_sleep(0.15), count(*) FROM actors'))
+                db.session.execute(text('SELECT pg_sleep(0.11)'))
+                db.session.rollback()
+            queries = profiler.slow_queries.queries()
+        finally:
+            profiler.slow_queries = slow_queries
+
+        self.assertEqual(len(queries), 1)
+        self.assertIn('FROM actors', queries[0]["statement"])
+        self.assertGreaterEqual(queries[0]["duration_ms"], 150)
+        self.assertTrue(queries[0]["explain"])
+
+    # For tracing testing
+
+    def test_trace_exported_for_sampled_request(self):
+        with exported_spans(sample_rate=1.0) as spans:
+            res = self.client().get('/actors',
+                                    headers=casting_assistant_auth_header)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('traceparent', res.headers)
+        self.assertEqual(len(set(s['trace_id'] for s in spans)), 1)
+        names = [s['name'] for s in spans]
+        for name in ['GET /actors', 'requires_auth', 'verify_decode_jwt',
+                     'jwks.fetch', 'jwt.decode', 'db.query', 'serialize']:
+            self.assertIn(name, names)
+
+    def test_sampled_flag_of_untrusted_traceparent_ignored(self):
+        trace_id = uuid.uuid4().hex
+        with exported_spans(sample_rate=0) as spans:
+            res = self.client().get(
+                '/actors',
+                headers=dict(casting_assistant_auth_header,
+                             traceparent=f'00-{trace_id}-{"1" * 16}-01'))
+
+        self.assertEqual(res.status_code, 200)
+        version, response_trace_id, _, flags = \
+            res.headers['traceparent'].split('-')
+        self.assertEqual(response_trace_id, trace_id)
+        self.assertEqual(flags, '00')
+        self.assertEqual(spans, [])
+
+    def test_json_logs_carry_trace_ids(self):
+        # the app logger is shared by the apps of the same name
+        root = logging.getLogger()
+        handlers = list(root.handlers)
+        app_handlers = list(self.app.logger.handlers)
+        log_format, tracing.LOG_FORMAT = tracing.LOG_FORMAT, 'json'
+        try:
+            app = create_app()
+            stream = io.StringIO()
+            root.handlers[0].setStream(stream)
+
+            @app.route('/logged')
+            def logged():
+                app.logger.warning('inside a request')
+                changefeed.logger.error('inside a module')
+                return 'logged'
+
+            res = app.test_client().get('/logged')
+        finally:
+            tracing.LOG_FORMAT = log_format
+            root.handlers = handlers
+            self.app.logger.handlers = app_handlers
+        entries = [json.loads(line)
+                   for line in stream.getvalue().splitlines()]
+        _, trace_id, span_id, _ = res.headers['traceparent'].split('-')
+
+        self.assertEqual([e['message'] for e in entries],
+                         ['inside a request', 'inside a module'])
+        self.assertEqual([e['logger'] for e in entries],
+                         [app.logger.name, 'changefeed'])
+        for entry in entries:
+            self.assertEqual(entry['trace_id'], trace_id)
+            self.assertEqual(entry['span_id'], span_id)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -0,0 +1,337 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import request
+from flask.logging import default_handler
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# fraction of requests traced from the start (head-based sampling)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+# honor the sampled flag of an incoming traceparent, only for deployments
+# whose callers are trusted, i.e. behind a gateway which sets the header.
+# Otherwise any client could have its requests exported, the trace is
+# continued but sampled at TRACE_SAMPLE_RATE
+TRACE_TRUST_PARENT = os.environ.get('TRACE_TRUST_PARENT', '') == 'true'
+# requests slower than this are exported anyway (tail-based sampling),
+# 0 disables it
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '1000'))
+# spans are written as json lines to this file, or to stdout if unset
+TRACE_EXPORT_FILE = os.environ.get('TRACE_EXPORT_FILE', '')
+# 'json' switches the app logger to structured json logs
+LOG_FORMAT = os.environ.get('LOG_FORMAT', '')
+
+MAX_SPANS_PER_TRACE = 1000
+
+_current_span = ContextVar('current_span', default=None)
+
+'''
+Spans
+a span follows the OpenTelemetry data model: it has a 128 bit trace id,
+a 64 bit span id, the id of its parent span, a name, start and end times
+in unix nanoseconds and a dict of attributes
+'''
+
+
+class Trace:
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent_span_id',
+                 'start', 'end', 'attributes', 'status')
+
+    def __init__(self, trace, name, parent_span_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_span_id = parent_span_id
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.status = 'OK'
+
+    def duration_ms(self):
+        return ((self.end or time.time_ns()) - self.start) / 1e6
+
+    def format(self):
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_span_id,
+            'name': self.name,
+            'start_time_unix_nano': self.start,
+            'end_time_unix_nano': self.end,
+            'duration_ms': round(self.duration_ms(), 3),
+            'attributes': self.attributes,
+            'status': self.status}
+
+
+class FileExporter:
+    '''
+    writes every span of a trace as one json line to a file or a stream
+    '''
+
+    def __init__(self, path=''):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(s.format(), default=str) + '\n'
+                        for s in spans)
+        with self.lock:
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(lines)
+            else:
+                sys.stdout.write(lines)
+                sys.stdout.flush()
+
+
+exporter = FileExporter(TRACE_EXPORT_FILE)
+
+
+def parse_traceparent(header):
+    """
+    return (trace_id, parent_span_id, sampled) of a W3C traceparent header
+    or None if the header is missing or malformed
+    """
+    if not header:
+        return None
+    parts = header.strip().split('-')
+    if(len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16):
+        return None
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def start_trace(name, traceparent=None, **attributes):
+    """
+    return the root span of a new trace, or None if the trace can not be
+    exported by either head or tail sampling
+
+    Keyword arguments:
+    name -- the name of the root span
+    traceparent -- the incoming W3C traceparent header, if any, its
+    sampled flag is only honored if TRACE_TRUST_PARENT is set
+    """
+    parent = parse_traceparent(traceparent)
+    if parent:
+        trace_id, parent_span_id, sampled = parent
+    else:
+        trace_id = '%032x' % random.getrandbits(128)
+        parent_span_id = None
+        sampled = False
+    if not (parent and TRACE_TRUST_PARENT):
+        sampled = random.random() < TRACE_SAMPLE_RATE
+    if not sampled and not TRACE_SLOW_MS:
+        return None
+    trace = Trace(trace_id, sampled)
+    root = Span(trace, name, parent_span_id, attributes)
+    trace.spans.append(root)
+    _current_span.set(root)
+    return root
+
+
+def end_trace(root):
+    """
+    end the root span and export the trace if it is sampled or slow
+    """
+    if root is None:
+        return
+    root.end = time.time_ns()
+    _current_span.set(None)
+    trace = root.trace
+    if(trace.sampled or
+       (TRACE_SLOW_MS and root.duration_ms() >= TRACE_SLOW_MS)):
+        exporter.export(trace.spans)
+
+
+def start_span(name, **attributes):
+    """
+    return (span, token) of a child of the current span, or (None, None)
+    when the current request is not traced
+    """
+    parent = _current_span.get()
+    if(parent is None or
+       len(parent.trace.spans) >= MAX_SPANS_PER_TRACE):
+        return None, None
+    s = Span(parent.trace, name, parent.span_id, attributes)
+    parent.trace.spans.append(s)
+    return s, _current_span.set(s)
+
+
+def end_span(s, token, error=None):
+    if s is None:
+        return
+    s.end = time.time_ns()
+    if error is not None:
+        s.status = 'ERROR'
+        s.attributes['error'] = repr(error)
+    _current_span.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    '''
+    trace the enclosed block as a child of the current span
+    '''
+    s, token = start_span(name, **attributes)
+    try:
+        yield s
+    except BaseException as e:
+        end_span(s, token, e)
+        raise
+    else:
+        end_span(s, token)
+
+
+def traced(name):
+    '''
+    return a decorator which traces every call of the decorated function
+    '''
+    def traced_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return traced_decorator
+
+
+def current_ids():
+    """
+    return (trace_id, span_id) of the current span or (None, None)
+    """
+    s = _current_span.get()
+    if s is None:
+        return None, None
+    return s.trace.trace_id, s.span_id
+
+
+# SQLAlchemy statements
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('trace_spans', []).append(
+        start_span('db.query', **{'db.system': conn.dialect.name,
+                                  'db.statement': statement}))
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    stack = conn.info.get('trace_spans')
+    if stack:
+        end_span(*stack.pop())
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    if context.connection is None:
+        return
+    stack = context.connection.info.get('trace_spans')
+    if stack:
+        end_span(*stack.pop(), error=context.original_exception)
+
+
+# Serialization
+
+class TracedJSONEncoder(JSONEncoder):
+    '''
+    the flask json encoder with a span around every jsonify call
+    '''
+
+    def encode(self, o):
+        with span('serialize'):
+            return super().encode(o)
+
+
+# Structured logs
+
+class JsonLogFormatter(logging.Formatter):
+    '''
+    formats a log record as one json line carrying the current trace ids
+    '''
+
+    def format(self, record):
+        trace_id, span_id = current_ids()
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'trace_id': trace_id,
+            'span_id': span_id}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def init_tracing(app, exempt_endpoints=()):
+    '''
+    init_tracing(app)
+        traces every request of a flask application as a root span
+
+    Keyword arguments:
+    exempt_endpoints -- endpoints not traced, i.e. long lived streams
+    '''
+    app.json_encoder = TracedJSONEncoder
+
+    # on the root logger, so that the loggers of the modules (i.e.
+    # changefeed) log json lines with the trace ids too
+    if LOG_FORMAT == 'json':
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonLogFormatter())
+        logging.getLogger().handlers = [handler]
+        app.logger.removeHandler(default_handler)
+
+    @app.before_request
+    def start_request_trace():
+        if request.endpoint in exempt_endpoints:
+            return
+        rule = request.url_rule.rule if request.url_rule else request.path
+        request.trace_root = start_trace(
+            f'{request.method} {rule}',
+            request.headers.get('traceparent'),
+            **{'http.method': request.method,
+               'http.target': request.full_path})
+
+    @app.after_request
+    def record_status_code(response):
+        root = getattr(request, 'trace_root', None)
+        if root is not None:
+            flags = '01' if root.trace.sampled else '00'
+            response.headers['traceparent'] = \
+                f'00-{root.trace.trace_id}-{root.span_id}-{flags}'
+            root.attributes['http.status_code'] = response.status_code
+        return response
+
+    # nested request contexts, such as the /batch sub-requests, have no
+    # trace_root and leave the trace of the outer request open
+    @app.teardown_request
+    def end_request_trace(error=None):
+        root = getattr(request, 'trace_root', None)
+        if root is not None and error is not None:
+            root.status = 'ERROR'
+            root.attributes['error'] = repr(error)
+        end_trace(root)